@@ -12,6 +12,8 @@ from email.mime.multipart import MIMEMultipart
 
 from flask import Flask, request, jsonify
 
+import tracing
+
 # -----------------------------------------------------------
 # CONFIGURAÇÕES
 # -----------------------------------------------------------
@@ -28,6 +30,8 @@ SMTP_USER = os.environ.get("SMTP_USER", "")
 SMTP_PASS = os.environ.get("SMTP_PASS", "")
 GEMINI_KEY = os.environ.get("GEMINI_KEY", "")
 GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro-exp:generateContent?key={GEMINI_KEY}"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+tracing.register_profiling_endpoint(app, ADMIN_TOKEN)
 
 # -----------------------------------------------------------
 # CACHE
@@ -52,7 +56,7 @@ def save_cache():
 # UTILS
 # -----------------------------------------------------------
 def log(msg: str):
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {tracing.tag()}{msg}")
 
 def send_email(subj: str, body: str):
     try:
@@ -73,6 +77,7 @@ def send_email(subj: str, body: str):
 # -----------------------------------------------------------
 # GEMINI
 # -----------------------------------------------------------
+@tracing.traced("gemini")
 def ask_gemini(prompt: str) -> str:
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
@@ -90,6 +95,7 @@ def ask_gemini(prompt: str) -> str:
 # -----------------------------------------------------------
 # SHEET
 # -----------------------------------------------------------
+@tracing.traced("sheet_lookup")
 def load_excel():
     # Simula 1a linha como cabeçalho: mlb, titulo, preco, disponivel, mensagem
     if SHEET_URL.endswith(".csv"):
@@ -132,6 +138,7 @@ def reply_uncle_cell(mlb: str, question: str) -> str:
 # WEBHOOK
 # -----------------------------------------------------------
 @app.route("/webhook", methods=["POST"])
+@tracing.traced("webhook", root=True, trace_id_from=lambda: request.headers.get(tracing.TRACE_ID_HEADER))
 def handle_notification():
     data = request.get_json(force=True)
     if not data:
@@ -150,8 +157,9 @@ def handle_notification():
     # obtém MLB e pergunta da API do Mercado Livre
     try:
         headers = {"Authorization": f"Bearer {TOKEN}"}
-        r = requests.get(f"https://api.mercadolibre.com{resource}", headers=headers)
-        r.raise_for_status()
+        with tracing.span("order_fetch", order_id=order_id):
+            r = requests.get(f"https://api.mercadolibre.com{resource}", headers=headers)
+            r.raise_for_status()
         order = r.json()
     except Exception as e:
         log(f"Erro ao buscar pedido: {e}")
@@ -0,0 +1,152 @@
+# Motor de cálculo de tarifas e valor líquido em lote, com regras versionadas
+import os
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+FEE_RULES_FILE = os.environ.get('FEE_RULES_FILE', 'fee_rules.json')
+FEE_SOURCES = ('fees_then_sale_fee', 'fees_only', 'sale_fee_only')
+COMPONENT_COLUMNS = ('fees_total', 'sale_fee_total', 'shipping_cost')
+# Alíquota usada pelo cálculo antigo (registros do livro-caixa sem componentes gravados)
+LEGACY_TAX_RATE = 0.0715
+
+FEE_NAME_MAP = {"listing_fee": "Tarifa de Venda", "fixed_fee": "Custo Fixo", "shipping_fee": "Custo de Envio (Tarifa)", "handling_fee": "Taxa de Manuseio"}
+
+@dataclass(frozen=True)
+class FeeRuleSet:
+    version: str
+    effective_from: datetime
+    tax_rate: float = LEGACY_TAX_RATE
+    fee_source: str = 'fees_then_sale_fee'
+    deduct_shipping: bool = True
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        effective_from = datetime.fromisoformat(data['effective_from'].replace('Z', '+00:00'))
+        if effective_from.tzinfo is None: effective_from = effective_from.replace(tzinfo=timezone.utc)
+        rule = cls(str(data['version']), effective_from, float(data.get('tax_rate', LEGACY_TAX_RATE)),
+                   data.get('fee_source', 'fees_then_sale_fee'), bool(data.get('deduct_shipping', True)))
+        if rule.fee_source not in FEE_SOURCES: raise ValueError(f"fee_source inválido na regra {rule.version}: {rule.fee_source}")
+        return rule
+
+DEFAULT_RULES = (FeeRuleSet('v1', datetime(2000, 1, 1, tzinfo=timezone.utc)),)
+
+def extract_fee_components(order_data: dict) -> dict:
+    """Lê do pedido as duas fontes de tarifa ('fees' e 'sale_fee' dos itens), sem aplicar regra."""
+    fee_details = []
+    fees_total = 0.0
+    for fee_component in order_data.get('fees', []):
+        fee_type = fee_component.get('type', 'desconhecida')
+        fee_cost = abs(fee_component.get('amount') or 0.0)
+        fees_total += fee_cost
+        fee_details.append((FEE_NAME_MAP.get(fee_type, fee_type.replace('_', ' ').title()), fee_cost))
+    sale_fee_total = sum((item.get('sale_fee') or 0.0) for item in order_data.get('order_items', []))
+    return {"fees_total": fees_total, "sale_fee_total": sale_fee_total, "fee_details": fee_details}
+
+def records_to_frame(records: list) -> pd.DataFrame:
+    frame = pd.DataFrame.from_records(records)
+    if frame.empty: frame = pd.DataFrame(columns=['timestamp', 'seller_id', 'gross', 'net'])
+    frame['timestamp'] = pd.to_datetime(frame['timestamp'], utc=True, format='ISO8601')
+    for column in COMPONENT_COLUMNS:
+        if column not in frame: frame[column] = np.nan
+    return frame
+
+class FeeEngine:
+    """Calcula tarifa ML, frete, imposto e líquido para um lote de vendas de uma só vez.
+
+    Cada venda usa a regra vigente na sua data (ou uma versão fixa, se informada).
+    Resultados por período do livro-caixa ficam em cache por versão de regra e
+    são invalidados quando o livro-caixa ou o arquivo de regras muda.
+    """
+    CACHE_SIZE = 32
+    def __init__(self, filename: str = None, rules=None):
+        self.filename = filename
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._set_rules(rules or DEFAULT_RULES)
+        if filename: self.reload_if_changed()
+    def _set_rules(self, rules):
+        rules = sorted(rules, key=lambda r: r.effective_from)
+        versions = [r.version for r in rules]
+        if len(set(versions)) != len(versions): raise ValueError(f"Versões de regra duplicadas: {versions}")
+        with self._lock:
+            self.rules = rules
+            self._effective_ts = np.array([r.effective_from.timestamp() for r in rules])
+            self._versions = np.array(versions, dtype=object)
+            self._tax_rates = np.array([r.tax_rate for r in rules])
+            self._sources = np.array([FEE_SOURCES.index(r.fee_source) for r in rules])
+            self._deduct_shipping = np.array([r.deduct_shipping for r in rules])
+            self._cache.clear()
+    def reload_if_changed(self) -> bool:
+        if not self.filename or not os.path.exists(self.filename): return False
+        try:
+            mtime = os.path.getmtime(self.filename)
+            if mtime == self._mtime: return False
+            with open(self.filename, 'r', encoding='utf-8') as f: config = json.load(f)
+            rules = [FeeRuleSet.from_dict(r) for r in config.get('rules', [])]
+            if not rules: raise ValueError("nenhuma regra definida")
+            self._set_rules(rules)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"!!! Falha ao carregar {self.filename}, mantendo regras anteriores: {e}")
+            return False
+        self._mtime = mtime
+        print(f"--- Regras de tarifa carregadas: {', '.join(f'{r.version} (desde {r.effective_from.date()}, imposto {r.tax_rate:.2%})' for r in self.rules)} ---")
+        return True
+    def _rule_indexes(self, timestamps: np.ndarray, version: str = None) -> np.ndarray:
+        if version:
+            if version not in self._versions: raise ValueError(f"Versão de regra desconhecida: {version}")
+            return np.full(len(timestamps), list(self._versions).index(version))
+        # Vendas anteriores à primeira regra usam a primeira regra
+        return np.clip(np.searchsorted(self._effective_ts, timestamps, side='right') - 1, 0, None)
+    def compute(self, frame: pd.DataFrame, version: str = None) -> pd.DataFrame:
+        """Recebe colunas timestamp, gross e os componentes; devolve uma cópia com ml_fee, shipping, tax, net e rule_version."""
+        result = frame.copy()
+        epoch = pd.Timestamp(0, tz='UTC')
+        timestamps = (pd.to_datetime(result['timestamp'], utc=True) - epoch).dt.total_seconds().to_numpy(dtype=float) if len(result) else np.empty(0)
+        idx = self._rule_indexes(timestamps, version)
+        gross = result['gross'].to_numpy(dtype=float)
+        fees, sale_fees, shipping = (result[c].to_numpy(dtype=float) for c in COMPONENT_COLUMNS)
+        source = self._sources[idx]
+        # Registros antigos só guardam bruto e líquido: tarifa + frete é deduzido do cálculo original
+        legacy = np.isnan(fees) | np.isnan(sale_fees) | np.isnan(shipping)
+        ml_fee = np.select([source == 0, source == 1], [np.where(fees > 0, fees, sale_fees), fees], default=sale_fees)
+        shipping = np.where(self._deduct_shipping[idx], shipping, 0.0)
+        if legacy.any():
+            stored_net = result['net'].to_numpy(dtype=float) if 'net' in result else np.full(len(result), np.nan)
+            ml_fee = np.where(legacy, gross - stored_net - gross * LEGACY_TAX_RATE, ml_fee)
+            shipping = np.where(legacy, 0.0, shipping)
+        tax = gross * self._tax_rates[idx]
+        result['ml_fee'], result['shipping'], result['tax'] = ml_fee, shipping, tax
+        result['net'] = gross - ml_fee - shipping - tax
+        result['rule_version'] = self._versions[idx]
+        result['fee_from_fees'] = (source == 1) | ((source == 0) & (fees > 0))
+        return result
+    def compute_one(self, when: datetime, gross: float, fees_total: float, sale_fee_total: float, shipping_cost: float, version: str = None) -> dict:
+        frame = pd.DataFrame({'timestamp': [pd.Timestamp(when)], 'gross': [gross], 'fees_total': [fees_total], 'sale_fee_total': [sale_fee_total], 'shipping_cost': [shipping_cost]})
+        row = self.compute(frame, version).iloc[0]
+        rule = self.rules[list(self._versions).index(row['rule_version'])]
+        return {"ml_fee": float(row['ml_fee']), "shipping": float(row['shipping']), "tax": float(row['tax']), "net": float(row['net']),
+                "rule_version": rule.version, "tax_rate": rule.tax_rate, "fee_from_fees": bool(row['fee_from_fees'])}
+    def compute_period(self, ledger, start_date: datetime, end_date: datetime, version: str = None) -> pd.DataFrame:
+        key = (ledger.signature(), start_date.isoformat(), end_date.isoformat(), version or '*', tuple(self._versions), self._mtime)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        result = self.compute(ledger.get_frame_for_period(start_date, end_date), version)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.CACHE_SIZE: self._cache.popitem(last=False)
+        return result
+
+def summarize(frame: pd.DataFrame) -> dict:
+    total_gross = float(frame['gross'].sum()) if len(frame) else 0.0
+    total_net = float(frame['net'].sum()) if len(frame) else 0.0
+    return {"units": int(len(frame)), "gross": total_gross, "net": total_net, "deductions": total_gross - total_net,
+            "by_rule_version": {str(k): int(v) for k, v in frame['rule_version'].value_counts().items()} if len(frame) else {}}
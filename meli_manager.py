@@ -9,6 +9,10 @@ import threading
 from datetime import datetime, timezone, timedelta
 import traceback
 
+import tracing
+import fee_engine
+from sharding import HashRing
+
 # --- CONFIGURAÇÕES GLOBAIS ---
 MEU_CLIENT_ID = os.environ.get('MEU_CLIENT_ID')
 MEU_CLIENT_SECRET = os.environ.get('MEU_CLIENT_SECRET')
@@ -17,32 +21,118 @@ TELEGRAM_CHAT_IDS_STR = os.environ.get('TELEGRAM_CHAT_IDS', '')
 TELEGRAM_CHAT_IDS = TELEGRAM_CHAT_IDS_STR.split(',') if TELEGRAM_CHAT_IDS_STR else []
 DEBUG_CHAT_ID = '8411108712'
 
-ACCOUNTS_CONFIG = {
-    323091477: {"client_id": MEU_CLIENT_ID, "client_secret": MEU_CLIENT_SECRET, "refresh_token": os.environ.get('REFRESH_TOKEN_323091477')},
-    268181565: {"client_id": MEU_CLIENT_ID, "client_secret": MEU_CLIENT_SECRET, "refresh_token": os.environ.get('REFRESH_TOKEN_268181565')},
-    702192285: {"client_id": MEU_CLIENT_ID, "client_secret": MEU_CLIENT_SECRET, "refresh_token": os.environ.get('REFRESH_TOKEN_702192285')},
-    75080160: {"client_id": MEU_CLIENT_ID, "client_secret": MEU_CLIENT_SECRET, "refresh_token": os.environ.get('REFRESH_TOKEN_75080160')}
-}
+ACCOUNTS_CONFIG_FILE = os.environ.get('ACCOUNTS_CONFIG_FILE', 'accounts.json')
+ACCOUNTS_RELOAD_SECONDS = int(os.environ.get('ACCOUNTS_RELOAD_SECONDS', 30))
+NODE_ID = os.environ.get('NODE_ID', '')
+CLUSTER_NODES_STR = os.environ.get('CLUSTER_NODES', '')
+SHARD_FORWARD_HEADER = 'X-Shard-Forwarded-By'
+CLUSTER_SECRET_HEADER = 'X-Cluster-Secret'
+CLUSTER_SECRET = os.environ.get('CLUSTER_SECRET', '')
+MAX_DEDUP_HOPS = 3
+QUEUE_MINIMUM_AGE = timedelta(minutes=5)
+# Após um rebalanceamento, o dono anterior só é consultado até sua fila esvaziar (maturação + margem de processamento)
+SHARD_HANDOFF_WINDOW = QUEUE_MINIMUM_AGE + timedelta(minutes=int(os.environ.get('SHARD_HANDOFF_MARGIN_MINUTES', 10)))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
 
 CUTOFF_DATE = datetime.now(timezone.utc)
 PROCESSED_ORDER_IDS = set()
 PROCESSED_IDS_LOCK = threading.Lock()
-LEDGER_FILE = "daily_ledger.json"
-COMMAND_QUEUE_FILE = "command_queue.json"
-
-SELLER_NICKNAMES = {
-    323091477: "EQUIPESCAFORTE",
-    268181565: "PORTE FORTE",
-    702192285: "PESCA E LAZER",
-    75080160: "PESCA_CAMPING"
-}
-
-SELLER_EMOJIS = {
-    323091477: "🐟",
-    268181565: "💪",
-    702192285: "☀️",
-    75080160: "🏕️"
-}
+
+def shard_filename(filename: str) -> str:
+    # Cada nó mantém sua própria fila/livro-caixa; sem NODE_ID o nome original é mantido
+    if not NODE_ID: return filename
+    base, ext = os.path.splitext(filename)
+    return f"{base}.{NODE_ID}{ext}"
+
+LEDGER_FILE = shard_filename("daily_ledger.json")
+COMMAND_QUEUE_FILE = shard_filename("command_queue.json")
+
+def parse_cluster_nodes(nodes_str: str) -> dict:
+    # Formato: "no-a=http://10.0.0.1:10000,no-b=http://10.0.0.2:10000"
+    nodes = {}
+    for entry in filter(None, (e.strip() for e in nodes_str.split(','))):
+        node_id, _, url = entry.partition('=')
+        nodes[node_id.strip()] = url.strip().rstrip('/') or None
+    return nodes
+
+class AccountRegistry:
+    """Contas e nós do cluster lidos de um arquivo JSON, recarregado quando o arquivo muda."""
+    def __init__(self, filename: str, node_id: str, default_nodes: dict):
+        self.filename, self.node_id, self.default_nodes = filename, node_id, default_nodes
+        self.accounts, self.nodes = {}, {}
+        self.ring = HashRing()
+        # seller_id -> (nó que era dono antes do último rebalanceamento, momento da mudança)
+        self.previous_owners = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+        if not self.reload_if_changed():
+            raise ValueError(f"Não foi possível carregar a configuração de contas: {filename}")
+    def _load(self):
+        with open(self.filename, 'r', encoding='utf-8') as f: config = json.load(f)
+        accounts = {}
+        for seller_id, entry in config.get('accounts', {}).items():
+            seller_id = int(seller_id)
+            refresh_token = entry.get('refresh_token') or os.environ.get(entry.get('refresh_token_env') or f"REFRESH_TOKEN_{seller_id}")
+            accounts[seller_id] = {
+                "client_id": entry.get('client_id') or MEU_CLIENT_ID,
+                "client_secret": entry.get('client_secret') or MEU_CLIENT_SECRET,
+                "refresh_token": refresh_token,
+                "nickname": entry.get('nickname') or f"ID {seller_id}",
+                "emoji": entry.get('emoji') or "🏪"
+            }
+        nodes = {str(k): (v.rstrip('/') if v else None) for k, v in (config.get('nodes') or {}).items()} or dict(self.default_nodes)
+        if not nodes: nodes = {self.node_id: None}
+        return accounts, nodes
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.filename)
+            if mtime == self._mtime: return False
+            accounts, nodes = self._load()
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"!!! Falha ao carregar {self.filename}, mantendo configuração anterior: {e}")
+            return False
+        previous_ring = self.ring
+        ring = HashRing(nodes.keys())
+        moved = [s for s in accounts if previous_ring.nodes and previous_ring.get_node(s) != ring.get_node(s)]
+        moved_at = time.time()
+        previous_owners = {s: e for s, e in self.previous_owners.items() if moved_at - e[1] <= SHARD_HANDOFF_WINDOW.total_seconds()}
+        for seller_id in moved: previous_owners[seller_id] = (previous_ring.get_node(seller_id), moved_at)
+        with self._lock:
+            self.accounts, self.nodes, self.ring, self.previous_owners, self._mtime = accounts, nodes, ring, previous_owners, mtime
+        if len(nodes) > 1 and not CLUSTER_SECRET:
+            print("!!! AVISO: CLUSTER_SECRET não configurado. Encaminhamentos e consultas entre nós serão recusados.")
+        if self.node_id not in nodes:
+            print(f"!!! AVISO: Nó '{self.node_id}' não consta em {list(nodes)}. Nenhum vendedor será atribuído a ele.")
+        owned = [s for s in accounts if ring.get_node(s) == self.node_id]
+        print(f"--- Configuração de contas carregada: {len(accounts)} contas, {len(nodes)} nó(s), {len(owned)} neste nó ({self.node_id}), {len(moved)} realocada(s). ---")
+        return True
+    @staticmethod
+    def _seller_key(seller_id):
+        # user_id vem do corpo da notificação; ids não numéricos são tratados como vendedor desconhecido
+        try: return int(seller_id)
+        except (TypeError, ValueError, OverflowError): return None
+    def is_managed(self, seller_id) -> bool:
+        return self._seller_key(seller_id) in self.accounts
+    def owner_of(self, seller_id):
+        key = self._seller_key(seller_id)
+        return self.ring.get_node(key) if key is not None else None
+    def previous_owner_of(self, seller_id):
+        key = self._seller_key(seller_id)
+        entry = self.previous_owners.get(key)
+        if not entry: return None
+        previous_owner, moved_at = entry
+        if time.time() - moved_at > SHARD_HANDOFF_WINDOW.total_seconds():
+            with self._lock: self.previous_owners.pop(key, None)
+            return None
+        return previous_owner
+    def owns(self, seller_id) -> bool:
+        return self.owner_of(seller_id) == self.node_id
+    def node_url(self, node_id):
+        return self.nodes.get(node_id)
+    def nickname_for(self, seller_id) -> str:
+        return self.accounts.get(self._seller_key(seller_id), {}).get('nickname', f"ID {seller_id}")
+    def emoji_for(self, seller_id) -> str:
+        return self.accounts.get(self._seller_key(seller_id), {}).get('emoji', "🏪")
 
 class CommandQueue:
     def __init__(self, filename):
@@ -63,6 +153,9 @@ class CommandQueue:
             queue.append(item)
             with open(self.filename, 'w') as f: json.dump(queue, f, indent=2)
             print(f"   - Ordem adicionada à Fila de Comando: {item['order_id']}")
+    def contains(self, order_id) -> bool:
+        with self._lock:
+            return any(item.get('order_id') == order_id for item in self._read_queue())
     def peek_next_item(self):
         with self._lock:
             queue = self._read_queue()
@@ -84,28 +177,56 @@ class DailyLedger:
         with self._lock:
             if not os.path.exists(self.filename):
                 with open(self.filename, 'w') as f: json.dump([], f)
-    def record_sale(self, seller_id, gross_value, net_value):
+    def record_sale(self, seller_id, gross_value, net_value, details=None, timestamp=None):
+        # `details` guarda os componentes brutos (tarifas, frete, versão da regra) para recálculo posterior;
+        # `timestamp` deve ser o mesmo instante usado para escolher a regra de tarifa
+        timestamp = timestamp or datetime.now(timezone.utc)
         with self._lock:
             records = self._read_records()
-            records.append({"timestamp": datetime.now(timezone.utc).isoformat(), "seller_id": seller_id, "gross": gross_value, "net": net_value})
+            records.append({"timestamp": timestamp.isoformat(), "seller_id": seller_id, "gross": gross_value, "net": net_value, **(details or {})})
             with open(self.filename, 'w') as f: json.dump(records, f, indent=2)
         print(f"   - Venda registrada no livro-caixa: {self.filename}")
+    def signature(self):
+        try:
+            stat = os.stat(self.filename)
+            return (self.filename, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError: return (self.filename, None, None)
+    def get_frame_for_period(self, start_date, end_date):
+        # O índice do DataFrame é a posição do registro no arquivo (o livro-caixa só recebe acréscimos)
+        frame = fee_engine.records_to_frame(self._read_records())
+        return frame[(frame['timestamp'] >= start_date) & (frame['timestamp'] < end_date)]
+    def apply_recomputed_net(self, recomputed):
+        with self._lock:
+            records = self._read_records()
+            for position, row in recomputed.iterrows():
+                record = records[position]
+                if 'fees_total' not in record:
+                    # Registro antigo: fixa a tarifa+frete deduzida para que o líquido regravado não altere recálculos futuros
+                    record.update({"fees_total": round(float(row['ml_fee']), 2), "sale_fee_total": round(float(row['ml_fee']), 2), "shipping_cost": 0.0})
+                record['net'] = round(float(row['net']), 2)
+                record['rule_version'] = row['rule_version']
+            with open(self.filename, 'w') as f: json.dump(records, f, indent=2)
+        print(f"   - {len(recomputed)} registro(s) recalculado(s) no livro-caixa: {self.filename}")
     def _read_records(self):
         try:
             with open(self.filename, 'r') as f: return json.load(f)
         except (FileNotFoundError, json.JSONDecodeError): return []
+    def get_order_ids(self) -> set:
+        return {r['order_id'] for r in self._read_records() if r.get('order_id') is not None}
     def get_records_for_period(self, start_date, end_date):
         records = self._read_records()
         return [r for r in records if start_date <= datetime.fromisoformat(r['timestamp']) < end_date]
 
 class MeliManager:
     API_URL = "https://api.mercadolibre.com"
-    def __init__(self, client_id: str, client_secret: str, refresh_token: str):
+    def __init__(self, client_id: str, client_secret: str, refresh_token: str, nickname: str = None):
         self.client_id, self.client_secret, self.refresh_token = client_id, client_secret, refresh_token
+        self.configured_credentials = (client_id, client_secret, refresh_token)
+        self.nickname = nickname or "ID Desconhecido"
         self.access_token, self.expires_at = None, 0
         self._lock = threading.Lock()
     def _refresh_token(self):
-        seller_nickname = SELLER_NICKNAMES.get(int(self.refresh_token.split('-')[-1]), "ID Desconhecido")
+        seller_nickname = self.nickname
         print(f"--- Renovando token para a conta: {seller_nickname} ---")
         url = f"{self.API_URL}/oauth/token"
         payload = {'grant_type': 'refresh_token', 'client_id': self.client_id, 'client_secret': self.client_secret, 'refresh_token': self.refresh_token}
@@ -121,6 +242,7 @@ class MeliManager:
         except requests.exceptions.RequestException as e:
             print(f"!!! Erro crítico ao renovar o token para {seller_nickname}: {e}")
             raise
+    @tracing.traced('token_fetch')
     def get_access_token(self) -> str:
         with self._lock:
             if not self.access_token or time.time() >= self.expires_at: self._refresh_token()
@@ -128,8 +250,23 @@ class MeliManager:
 
 class MultiMeliManager:
     def __init__(self, accounts_config: dict):
-        self.managers = {str(seller_id): MeliManager(c['client_id'], c['client_secret'], c['refresh_token']) for seller_id, c in accounts_config.items() if c.get('refresh_token')}
+        self.managers = {}
+        self._lock = threading.Lock()
+        self.sync(accounts_config)
         print(f"Comandante de Frota iniciado com {len(self.managers)} contas sob vigilância.")
+    def sync(self, accounts_config: dict):
+        # Preserva gerentes (e tokens em cache) de contas cujas credenciais não mudaram
+        with self._lock:
+            managers = {}
+            for seller_id, c in accounts_config.items():
+                if not c.get('refresh_token'): continue
+                current = self.managers.get(str(seller_id))
+                if current and current.configured_credentials == (c['client_id'], c['client_secret'], c['refresh_token']):
+                    current.nickname = c.get('nickname') or current.nickname
+                    managers[str(seller_id)] = current
+                else:
+                    managers[str(seller_id)] = MeliManager(c['client_id'], c['client_secret'], c['refresh_token'], c.get('nickname'))
+            self.managers = managers
     def get_manager_for_seller(self, seller_id: int):
         return self.managers.get(str(seller_id))
 
@@ -139,6 +276,7 @@ class TelegramNotifier:
         if not bot_token or "COLE_SEU" in bot_token: raise ValueError("Token do Bot do Telegram não foi preenchido!")
         if not chat_ids: raise ValueError("A lista de Chat IDs do Telegram está vazia!")
         self.bot_token, self.chat_ids = bot_token, chat_ids
+    @tracing.traced('telegram_send')
     def send_message(self, text: str):
         print(f"Enviando mensagem para {len(self.chat_ids)} destinatário(s)...")
         for chat_id in self.chat_ids:
@@ -154,7 +292,92 @@ class TelegramNotifier:
 
 app = Flask(__name__)
 
+def cluster_headers() -> dict:
+    headers = {SHARD_FORWARD_HEADER: account_registry.node_id, CLUSTER_SECRET_HEADER: CLUSTER_SECRET, tracing.TRACE_ID_HEADER: tracing.current_trace_id()}
+    return {k: v for k, v in headers.items() if v}
+
+def is_cluster_request() -> bool:
+    return tracing.secrets_match(request.headers.get(CLUSTER_SECRET_HEADER), CLUSTER_SECRET)
+
+def forward_to_owner(owner: str, notification_data: dict):
+    # Falhas de encaminhamento devolvem 503 para que o Mercado Livre reenvie a notificação
+    owner_url = account_registry.node_url(owner)
+    if not owner_url:
+        print(f"!!! ERRO NA TRIAGEM: Nó dono '{owner}' sem endereço configurado. Pedindo reenvio ao Mercado Livre.")
+        return "Shard sem endereço", 503
+    try:
+        with tracing.span('shard_forward', owner=owner):
+            response = requests.post(f"{owner_url}/ml-notifications", json=notification_data, headers=cluster_headers(), timeout=10)
+        response.raise_for_status()
+        print(f"   - Notificação do vendedor {notification_data.get('user_id')} encaminhada ao nó '{owner}'.")
+    except requests.exceptions.RequestException as e:
+        print(f"!!! ERRO NA TRIAGEM: Falha ao encaminhar notificação ao nó '{owner}'. Pedindo reenvio ao Mercado Livre. Erro: {e}")
+        return "Falha ao encaminhar", 503
+    return "OK (encaminhado)", 200
+
+tracing.register_profiling_endpoint(app, ADMIN_TOKEN)
+
+def parse_admin_date(value, default):
+    if value is None or value == '': return default
+    if not isinstance(value, str): raise ValueError(f"Data inválida (esperado texto ISO 8601): {value!r}")
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+@app.route("/admin/recompute", methods=['POST'])
+def admin_recompute():
+    # Recalcula o líquido de um período do livro-caixa com as regras vigentes (ou uma versão fixa)
+    if not tracing.is_admin_request(request.headers, ADMIN_TOKEN):
+        return {"error": "forbidden"}, 403
+    params = request.get_json(silent=True) or {}
+    try:
+        start_date = parse_admin_date(params.get('start'), datetime.min.replace(tzinfo=timezone.utc))
+        end_date = parse_admin_date(params.get('end'), datetime.now(timezone.utc) + timedelta(days=1))
+        recomputed = fee_calculator.compute_period(ledger, start_date, end_date, params.get('version'))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    if params.get('persist') and len(recomputed):
+        ledger.apply_recomputed_net(recomputed)
+    return {"start": start_date.isoformat(), "end": end_date.isoformat(), "persisted": bool(params.get('persist')), **fee_engine.summarize(recomputed)}, 200
+
+def is_order_known_locally(order_id) -> bool:
+    with PROCESSED_IDS_LOCK:
+        if order_id in PROCESSED_ORDER_IDS: return True
+    return command_queue.contains(order_id)
+
+def previous_owner_knows_order(seller_id, order_id, hops: int = 0) -> bool:
+    # Após um rebalanceamento, o dono anterior continua autoritativo para as ordens que já enfileirou ou processou
+    previous_owner = account_registry.previous_owner_of(seller_id)
+    if not previous_owner or previous_owner == account_registry.node_id or hops >= MAX_DEDUP_HOPS: return False
+    owner_url = account_registry.node_url(previous_owner)
+    if not owner_url:
+        print(f"   - AVISO: Dono anterior '{previous_owner}' sem endereço configurado. Deduplicação apenas local.")
+        return False
+    try:
+        with tracing.span('shard_dedup_lookup', previous_owner=previous_owner):
+            response = requests.post(f"{owner_url}/shard/orders/known", json={"seller_id": seller_id, "order_id": order_id, "hops": hops + 1},
+                                     headers=cluster_headers(), timeout=10)
+            response.raise_for_status()
+        return bool(response.json().get('known'))
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"   - AVISO: Falha ao consultar o dono anterior '{previous_owner}' sobre a venda {order_id}. Deduplicação apenas local. Erro: {e}")
+        return False
+
+@app.route("/shard/orders/known", methods=['POST'])
+@tracing.traced('shard-order-known', root=True, trace_id_from=lambda: request.headers.get(tracing.TRACE_ID_HEADER))
+def shard_order_known():
+    if not is_cluster_request(): return {"error": "forbidden"}, 403
+    params = request.get_json(silent=True) or {}
+    seller_id, order_id = params.get('seller_id'), params.get('order_id')
+    try:
+        hops = int(params.get('hops', MAX_DEDUP_HOPS))
+        if seller_id is None or order_id is None: raise ValueError("seller_id e order_id são obrigatórios")
+        known = is_order_known_locally(order_id) or (account_registry.is_managed(seller_id) and previous_owner_knows_order(seller_id, order_id, hops))
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+    return {"known": known}, 200
+
 @app.route("/ml-notifications", methods=['POST'])
+@tracing.traced('ml-notification', root=True, trace_id_from=lambda: request.headers.get(tracing.TRACE_ID_HEADER))
 def handle_ml_notification():
     notification_data = request.json
     seller_id = notification_data.get('user_id')
@@ -166,6 +389,17 @@ def handle_ml_notification():
     resource_path = notification_data.get('resource')
     if not resource_path: return "OK (no resource)", 200
 
+    # Só outro nó do cluster (com o segredo compartilhado) pode marcar uma notificação como encaminhada
+    forwarded = bool(request.headers.get(SHARD_FORWARD_HEADER))
+    if forwarded and not is_cluster_request():
+        print("!!! ERRO NA TRIAGEM: Notificação marcada como encaminhada sem o segredo do cluster. Recusada.")
+        return "Forbidden", 403
+
+    if not account_registry.is_managed(seller_id): return "OK (vendedor não gerenciado)", 200
+    # Notificações já encaminhadas são aceitas mesmo durante um rebalanceamento, evitando laços
+    if not account_registry.owns(seller_id) and not forwarded:
+        return forward_to_owner(account_registry.owner_of(seller_id), notification_data)
+
     try:
         payment_id = int(resource_path.split('/')[-1])
         manager = multi_manager.get_manager_for_seller(seller_id)
@@ -173,8 +407,9 @@ def handle_ml_notification():
         
         token = manager.get_access_token()
         headers = {'Authorization': f'Bearer {token}'}
-        payment_response = requests.get(f"{MeliManager.API_URL}{resource_path}", headers=headers)
-        payment_response.raise_for_status()
+        with tracing.span('payment_fetch', payment_id=payment_id):
+            payment_response = requests.get(f"{MeliManager.API_URL}{resource_path}", headers=headers)
+            payment_response.raise_for_status()
         payment_data = payment_response.json()
 
         if payment_data.get('status') == 'approved' and payment_data.get('order_id'):
@@ -182,22 +417,25 @@ def handle_ml_notification():
             
             with PROCESSED_IDS_LOCK:
                 if order_id in PROCESSED_ORDER_IDS:
-                    print(f"   - Venda duplicada (ID: {order_id}) já na fila ou processada. Ignorando.")
+                    print(f"   - {tracing.tag()}Venda duplicada (ID: {order_id}) já na fila ou processada. Ignorando.")
                     return "OK (duplicate)", 200
+            if previous_owner_knows_order(seller_id, order_id):
+                print(f"   - {tracing.tag()}Venda duplicada (ID: {order_id}) já recebida pelo dono anterior do vendedor. Ignorando.")
+                with PROCESSED_IDS_LOCK: PROCESSED_ORDER_IDS.add(order_id)
+                return "OK (duplicate)", 200
             
             command_queue.add_to_queue({
                 "seller_id": seller_id,
                 "order_id": order_id,
-                "timestamp": datetime.now(timezone.utc).isoformat()
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "trace_id": tracing.current_trace_id()
             })
     except Exception as e:
-        print(f"!!! ERRO NA TRIAGEM: Falha ao adicionar à fila. Erro: {e}")
+        print(f"!!! {tracing.tag()}ERRO NA TRIAGEM: Falha ao adicionar à fila. Erro: {e}")
 
     return "OK", 200
 
 def process_command_queue():
-    MINIMUM_AGE = timedelta(minutes=5)
-    
     while True:
         item_to_process = None
         
@@ -206,11 +444,11 @@ def process_command_queue():
             item_timestamp = datetime.fromisoformat(next_item['timestamp'])
             item_age = datetime.now(timezone.utc) - item_timestamp
             
-            if item_age >= MINIMUM_AGE:
+            if item_age >= QUEUE_MINIMUM_AGE:
                 item_to_process = command_queue.get_next_item()
                 print(f"\n\n--- 🕵️ Ordem {item_to_process['order_id']} madura. Autorizando processamento. ---")
             else:
-                wait_time = (MINIMUM_AGE - item_age).total_seconds()
+                wait_time = (QUEUE_MINIMUM_AGE - item_age).total_seconds()
                 print(f"   - Próxima ordem {next_item['order_id']} muito recente. Maturando por mais {int(wait_time)}s...")
         
         if not item_to_process:
@@ -220,7 +458,8 @@ def process_command_queue():
         seller_id = item_to_process['seller_id']
         order_id = item_to_process['order_id']
         
-        print(f"--- ⚙️ Processando Ordem da Fila de Comando: {order_id} ---")
+        order_trace = tracing.Trace(item_to_process.get('trace_id'), 'queued-order', order_id=order_id, seller_id=seller_id).start()
+        print(f"--- ⚙️ {tracing.tag()}Processando Ordem da Fila de Comando: {order_id} ---")
 
         try:
             with PROCESSED_IDS_LOCK:
@@ -228,6 +467,10 @@ def process_command_queue():
                     print(f"   - Venda duplicada (ID: {order_id}) já na lista final. Ignorando.")
                     continue
                 PROCESSED_ORDER_IDS.add(order_id)
+            # Rechecagem na hora de processar: os nós recarregam a configuração em momentos diferentes
+            if previous_owner_knows_order(seller_id, order_id):
+                print(f"   - Venda duplicada (ID: {order_id}) já tratada pelo dono anterior do vendedor. Ignorando.")
+                continue
 
             manager = multi_manager.get_manager_for_seller(seller_id)
             if not manager:
@@ -242,20 +485,21 @@ def process_command_queue():
             max_retries = 3
             retry_delay = 15 
 
-            for attempt in range(max_retries):
-                try:
-                    print(f"   - Tentativa {attempt + 1}/{max_retries} para buscar detalhes da venda {order_id}...")
-                    order_response = requests.get(order_details_url, headers=headers, timeout=15)
-                    order_response.raise_for_status()
-                    print(f"   - Detalhes da venda {order_id} obtidos com sucesso.")
-                    break 
-                except requests.exceptions.HTTPError as e:
-                    if e.response.status_code == 404 and attempt < max_retries - 1:
-                        print(f"   - AVISO: Venda {order_id} não encontrada (404). Aguardando {retry_delay}s para nova tentativa.")
-                        time.sleep(retry_delay)
-                    else:
-                        print(f"   - ERRO FINAL: Não foi possível obter detalhes da venda {order_id} após {max_retries} tentativas.")
-                        raise 
+            with tracing.span('order_fetch', order_id=order_id):
+                for attempt in range(max_retries):
+                    try:
+                        print(f"   - Tentativa {attempt + 1}/{max_retries} para buscar detalhes da venda {order_id}...")
+                        order_response = requests.get(order_details_url, headers=headers, timeout=15)
+                        order_response.raise_for_status()
+                        print(f"   - Detalhes da venda {order_id} obtidos com sucesso.")
+                        break 
+                    except requests.exceptions.HTTPError as e:
+                        if e.response.status_code == 404 and attempt < max_retries - 1:
+                            print(f"   - AVISO: Venda {order_id} não encontrada (404). Aguardando {retry_delay}s para nova tentativa.")
+                            time.sleep(retry_delay)
+                        else:
+                            print(f"   - ERRO FINAL: Não foi possível obter detalhes da venda {order_id} após {max_retries} tentativas.")
+                            raise 
             
             if not order_response:
                 print(f"   - ERRO GRAVE: A resposta da venda {order_id} é nula mesmo após as tentativas.")
@@ -274,52 +518,50 @@ def process_command_queue():
 
             total_amount = order_data.get('total_amount', 0)
             shipping_cost = 0.0
-            mercadolibre_total_fee = 0.0
-            fee_details_list = []
 
             # --- MÓDULO DE DUPLA VERIFICAÇÃO FINANCEIRA ---
-
-            # FASE 1: Busca Primária no campo "fees"
-            detailed_fees = order_data.get('fees', [])
-            if detailed_fees:
-                print("   - Fonte de Tarifa: Campo 'fees' (Primário)")
-                for fee_component in detailed_fees:
-                    fee_type = fee_component.get('type', 'desconhecida')
-                    fee_amount = fee_component.get('amount') or 0.0
-                    fee_cost = abs(fee_amount)
-                    mercadolibre_total_fee += fee_cost
-                    
-                    fee_name_map = {"listing_fee": "Tarifa de Venda", "fixed_fee": "Custo Fixo", "shipping_fee": "Custo de Envio (Tarifa)", "handling_fee": "Taxa de Manuseio"}
-                    fee_name = fee_name_map.get(fee_type, fee_type.replace('_', ' ').title())
-                    fee_details_list.append(f"   <em>- {fee_name}: R$ {fee_cost:.2f}</em>")
-
-            # FASE 2: Busca Secundária (Fallback) no campo "sale_fee" dentro dos itens
-            if mercadolibre_total_fee == 0:
-                print("   - Fonte de Tarifa: Campo 'sale_fee' nos itens (Secundário)")
-                for order_item_data in order_data.get('order_items', []):
-                    sale_fee = order_item_data.get('sale_fee') or 0.0
-                    mercadolibre_total_fee += sale_fee
-                if mercadolibre_total_fee > 0:
-                    fee_details_list.append(f"   <em>- Tarifa de Venda (Agregada): R$ {mercadolibre_total_fee:.2f}</em>")
+            # Fontes de tarifa ('fees' primário, 'sale_fee' secundário) e imposto vêm da regra vigente no fee_engine
+            fee_components = fee_engine.extract_fee_components(order_data)
 
             # Custo de Envio (Etiqueta)
             shipping_id = order_data.get('shipping', {}).get('id')
             if shipping_id:
                 costs_url = f"{MeliManager.API_URL}/shipments/{shipping_id}/costs"
-                costs_response = requests.get(costs_url, headers=headers)
+                with tracing.span('shipment_costs', shipping_id=shipping_id):
+                    costs_response = requests.get(costs_url, headers=headers)
                 if costs_response.status_code == 200:
                     costs_data = costs_response.json()
                     for sender in costs_data.get('senders', []):
                         if sender.get('user_id') == seller_id:
                             shipping_cost += sender.get('cost') or 0.0
 
-            imposto_valor = total_amount * 0.0715
-            valor_liquido = total_amount - mercadolibre_total_fee - shipping_cost - imposto_valor
-            
-            ledger.record_sale(seller_id, total_amount, valor_liquido)
+            recorded_at = datetime.now(timezone.utc)
+            with tracing.span('fee_calculation'):
+                financials = fee_calculator.compute_one(recorded_at, total_amount, fee_components['fees_total'], fee_components['sale_fee_total'], shipping_cost)
+            mercadolibre_total_fee = financials['ml_fee']
+            imposto_valor = financials['tax']
+            valor_liquido = financials['net']
 
-            seller_nickname = SELLER_NICKNAMES.get(seller_id, f"ID {seller_id}")
-            seller_emoji = SELLER_EMOJIS.get(seller_id, "🏪")
+            fee_details_list = []
+            if financials['fee_from_fees']:
+                print("   - Fonte de Tarifa: Campo 'fees' (Primário)")
+                fee_details_list = [f"   <em>- {fee_name}: R$ {fee_cost:.2f}</em>" for fee_name, fee_cost in fee_components['fee_details']]
+            else:
+                print("   - Fonte de Tarifa: Campo 'sale_fee' nos itens (Secundário)")
+                if mercadolibre_total_fee > 0:
+                    fee_details_list.append(f"   <em>- Tarifa de Venda (Agregada): R$ {mercadolibre_total_fee:.2f}</em>")
+
+            with tracing.span('ledger_write'):
+                ledger.record_sale(seller_id, total_amount, valor_liquido, {
+                    "order_id": order_id,
+                    "fees_total": fee_components['fees_total'],
+                    "sale_fee_total": fee_components['sale_fee_total'],
+                    "shipping_cost": shipping_cost,
+                    "rule_version": financials['rule_version']
+                }, timestamp=recorded_at)
+
+            seller_nickname = account_registry.nickname_for(seller_id)
+            seller_emoji = account_registry.emoji_for(seller_id)
             buyer_info = order_data.get('buyer', {})
             full_buyer_name = f"{buyer_info.get('first_name', '')} {buyer_info.get('last_name', '')}".strip() or buyer_info.get('nickname', 'N/A')
             sale_datetime_str = sale_datetime_obj.strftime('%d/%m/%Y às %H:%M')
@@ -348,8 +590,9 @@ def process_command_queue():
             if shipping_cost > 0:
                 message += f"🚛 <b>Custo de Envio (Etiqueta):</b> -R$ {shipping_cost:.2f}\n"
             
+            aliquota_str = f"{financials['tax_rate'] * 100:.2f}".replace('.', ',')
             message += (
-                f"📉 <b>Imposto (7,15%):</b> -R$ {imposto_valor:.2f}\n"
+                f"📉 <b>Imposto ({aliquota_str}%):</b> -R$ {imposto_valor:.2f}\n"
                 f"✅ <b>Valor Líquido Final:</b> R$ {valor_liquido:.2f}"
             )
             
@@ -357,13 +600,15 @@ def process_command_queue():
             print("   - ✅ Notificação de venda enviada com sucesso via Telegram.")
 
         except Exception as e:
-            print(f"!!! FALHA CRÍTICA AO PROCESSAR A FILA. Erro: {e}")
+            order_trace.error = f"{type(e).__name__}: {e}"
+            print(f"!!! {tracing.tag()}FALHA CRÍTICA AO PROCESSAR A FILA. Erro: {e}")
             error_details = traceback.format_exc()
             print(error_details)
             error_message_for_debug = (
                 f"🚨 <b>ALERTA DE FALHA - ALMIRANTE v6.0 (FILA)</b> 🚨\n\n"
                 f"Ocorreu um erro ao tentar processar uma venda da fila de comando.\n\n"
                 f"<b>ID da Venda:</b> {order_id}\n"
+                f"<b>Trace:</b> {order_trace.trace_id}\n"
                 f"<b>Erro:</b>\n<pre>{str(e)}</pre>\n\n"
                 f"<b>Detalhes Técnicos:</b>\n<pre>{error_details}</pre>"
             )
@@ -373,24 +618,30 @@ def process_command_queue():
                 print(f"   - ✅ Mensagem de DEBUG da Caixa-Preta enviada para o ID {DEBUG_CHAT_ID}.")
             except Exception as debug_e:
                 print(f"!!! FALHA CATASTRÓFICA: Não foi possível enviar nem a mensagem de DEBUG. Erro: {debug_e}")
+        finally:
+            order_trace.finish()
+
+def shard_report_label() -> str:
+    # Com vários nós, cada um reporta apenas os vendedores do seu shard
+    if len(account_registry.nodes) <= 1: return ""
+    return f"<em>Shard: {account_registry.node_id}</em>\n"
 
 def send_daily_report():
     print("\n\n--- ⚙️  Gerando Relatório Diário... ---")
     today = datetime.now(timezone.utc).date()
     start_of_day = datetime(today.year, today.month, today.day, tzinfo=timezone.utc)
     end_of_day = start_of_day + timedelta(days=1)
-    records = ledger.get_records_for_period(start_of_day, end_of_day)
-    if not records:
+    totals = fee_engine.summarize(fee_calculator.compute_period(ledger, start_of_day, end_of_day))
+    if not totals['units']:
         print("--- 📪  Nenhuma venda registrada hoje. Relatório não enviado. ---")
         return
-    total_gross = sum(r['gross'] for r in records)
-    total_net = sum(r['net'] for r in records)
-    total_units = len(records)
-    total_deductions = total_gross - total_net
+    total_gross, total_net, total_units = totals['gross'], totals['net'], totals['units']
+    total_deductions = totals['deductions']
     profit_percentage = (total_deductions / total_gross * 100) if total_gross > 0 else 0
     message = (
         f"📊 <b>RELATÓRIO DIÁRIO DE VENDAS</b> 📊\n"
-        f"<em>Data: {today.strftime('%d/%m/%Y')}</em>\n\n"
+        f"<em>Data: {today.strftime('%d/%m/%Y')}</em>\n"
+        f"{shard_report_label()}\n"
         f"📦 <b>Unidades Vendidas:</b> {total_units}\n\n"
         f"💵 <b>Faturamento Bruto:</b> R$ {total_gross:.2f}\n"
         f"✅ <b>Faturamento Líquido:</b> R$ {total_net:.2f}\n\n"
@@ -410,18 +661,17 @@ def send_monthly_report():
     print("--- ⚙️  É o último dia do mês! Gerando Relatório Mensal... ---")
     start_of_month = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
     end_of_month = (start_of_month + timedelta(days=32)).replace(day=1)
-    records = ledger.get_records_for_period(start_of_month, end_of_month)
-    if not records:
+    totals = fee_engine.summarize(fee_calculator.compute_period(ledger, start_of_month, end_of_month))
+    if not totals['units']:
         print("--- 📪  Nenhuma venda registrada no mês. Relatório não enviado. ---")
         return
-    total_gross = sum(r['gross'] for r in records)
-    total_net = sum(r['net'] for r in records)
-    total_units = len(records)
-    total_deductions = total_gross - total_net
+    total_gross, total_net, total_units = totals['gross'], totals['net'], totals['units']
+    total_deductions = totals['deductions']
     profit_percentage = (total_deductions / total_gross * 100) if total_gross > 0 else 0
     message = (
         f"🏆 <b>RELATÓRIO MENSAL CONSOLIDADO</b> 🏆\n"
-        f"<em>Mês de Referência: {now.strftime('%B de %Y')}</em>\n\n"
+        f"<em>Mês de Referência: {now.strftime('%B de %Y')}</em>\n"
+        f"{shard_report_label()}\n"
         f"📦 <b>Total de Unidades Vendidas:</b> {total_units}\n\n"
         f"💵 <b>Faturamento Bruto Total:</b> R$ {total_gross:.2f}\n"
         f"✅ <b>Faturamento Líquido Total:</b> R$ {total_net:.2f}\n\n"
@@ -431,7 +681,13 @@ def send_monthly_report():
     telegram_notifier.send_message(message)
     print("--- ✅  Relatório Mensal enviado com sucesso! ---\n")
 
+def reload_config():
+    if account_registry.reload_if_changed():
+        multi_manager.sync(account_registry.accounts)
+    fee_calculator.reload_if_changed()
+
 def run_scheduler():
+    schedule.every(ACCOUNTS_RELOAD_SECONDS).seconds.do(reload_config)
     schedule.every().day.at("23:59").do(send_daily_report)
     schedule.every().day.at("23:58").do(send_monthly_report)
     while True:
@@ -447,9 +703,17 @@ if __name__ == "__main__":
         print("!!! ERRO CRÍTICO: Variáveis de ambiente essenciais não foram configuradas.")
         exit(1)
 
+    try:
+        account_registry = AccountRegistry(ACCOUNTS_CONFIG_FILE, NODE_ID or 'principal', parse_cluster_nodes(CLUSTER_NODES_STR))
+    except ValueError as e:
+        print(f"!!! ERRO CRÍTICO: {e}")
+        exit(1)
+
     command_queue = CommandQueue(COMMAND_QUEUE_FILE)
     ledger = DailyLedger(LEDGER_FILE)
-    multi_manager = MultiMeliManager(ACCOUNTS_CONFIG)
+    PROCESSED_ORDER_IDS.update(ledger.get_order_ids())
+    fee_calculator = fee_engine.FeeEngine(fee_engine.FEE_RULES_FILE)
+    multi_manager = MultiMeliManager(account_registry.accounts)
     telegram_notifier = TelegramNotifier(bot_token=TELEGRAM_BOT_TOKEN, chat_ids=TELEGRAM_CHAT_IDS)
     
     queue_processor_thread = threading.Thread(target=process_command_queue)
@@ -465,6 +729,8 @@ if __name__ == "__main__":
     print(f"  Linha do tempo definida. Ignorando vendas anteriores a: {CUTOFF_DATE.strftime('%d/%m/%Y %H:%M:%S')}")
     print("  General de Inteligência Financeira inspecionando a fila a cada 30s.")
     print("  Motor de relatórios diários e mensais engajado.")
+    print(f"  Nó '{account_registry.node_id}' de {len(account_registry.nodes)}. Contas recarregadas de {ACCOUNTS_CONFIG_FILE} a cada {ACCOUNTS_RELOAD_SECONDS}s.")
+    print(f"  Traces gravados em {tracing.trace_file_path()}. Profiling sob demanda em /admin/profiling.")
     print("  Servidor web (Triage) iniciando para receber notificações...")
     print("======================================================================")
     
@@ -0,0 +1,42 @@
+# Anel de hash consistente para distribuir vendedores entre nós/processos
+import bisect
+import hashlib
+
+
+class HashRing:
+    """Distribui chaves (seller_id) entre nós com hash consistente.
+
+    Cada nó ocupa `replicas` pontos virtuais no anel; ao adicionar ou remover
+    um nó, apenas as chaves vizinhas aos seus pontos mudam de dono.
+    """
+    def __init__(self, nodes=(), replicas: int = 128):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        self._nodes = set()
+        for node in nodes: self.add_node(node)
+    @staticmethod
+    def _hash(key) -> int:
+        return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:16], 16)
+    @property
+    def nodes(self) -> list:
+        return sorted(self._nodes)
+    def add_node(self, node: str):
+        if node in self._nodes: return
+        self._nodes.add(node)
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+    def remove_node(self, node: str):
+        if node not in self._nodes: return
+        self._nodes.discard(node)
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+    def get_node(self, key):
+        if not self._points: return None
+        idx = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[idx]]
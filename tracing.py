@@ -0,0 +1,292 @@
+# Rastreamento de requisições (trace id + spans cronometrados) e profiler amostral sob demanda
+import os
+import io
+import re
+import hmac
+import sys
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import logging
+import threading
+import functools
+import contextvars
+from collections import Counter
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+# Base do nome; cada processo grava no próprio arquivo (traces.<pid>.jsonl), pois a rotação não é segura entre processos
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 5 * 1024 * 1024))
+TRACE_BACKUP_COUNT = int(os.environ.get('TRACE_BACKUP_COUNT', 5))
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', '1') != '0'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+TRACE_ID_HEADER = 'X-Trace-Id'
+
+TRACE_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+
+_current_trace_id = contextvars.ContextVar('trace_id', default=None)
+_current_span_id = contextvars.ContextVar('span_id', default=None)
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+def trace_file_path() -> str:
+    base, ext = os.path.splitext(TRACE_FILE)
+    return f"{base}.{os.getpid()}{ext}"
+
+def _get_writer():
+    global _writer, _writer_pid
+    with _writer_lock:
+        # Recria o handler após um fork (ex.: workers do gunicorn com --preload)
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = logging.getLogger('tracing.spans')
+            _writer.setLevel(logging.INFO)
+            _writer.propagate = False
+            for old_handler in list(_writer.handlers): _writer.removeHandler(old_handler)
+            handler = RotatingFileHandler(trace_file_path(), maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _writer.addHandler(handler)
+            _writer_pid = os.getpid()
+        return _writer
+
+def _write(record: dict):
+    if not TRACING_ENABLED: return
+    try:
+        _get_writer().info(json.dumps(record, ensure_ascii=False, default=str))
+    except Exception as e:
+        print(f"!!! Falha ao gravar trace: {e}")
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+def valid_trace_id(value) -> bool:
+    # Trace ids externos (cabeçalho, fila) só são aceitos no formato gerado por new_trace_id()
+    return isinstance(value, str) and bool(TRACE_ID_PATTERN.match(value))
+
+def current_trace_id():
+    return _current_trace_id.get()
+
+def tag() -> str:
+    # Prefixo de correlação para os prints das threads
+    trace_id = _current_trace_id.get()
+    return f"[trace {trace_id}] " if trace_id else ""
+
+class Span:
+    """Trecho cronometrado; gravado no arquivo de traces ao terminar."""
+    kind = 'span'
+    def __init__(self, name: str, **attrs):
+        self.name, self.attrs = name, attrs
+        self.span_id = uuid.uuid4().hex[:8]
+        self.error = None
+        self._tokens = []
+    def start(self):
+        self.parent_id = _current_span_id.get()
+        self._tokens.append(_current_span_id.set(self.span_id))
+        self.started_at = datetime.now(timezone.utc)
+        self._t0 = time.perf_counter()
+        return self
+    def finish(self):
+        duration_ms = (time.perf_counter() - self._t0) * 1000
+        record = {
+            "ts": self.started_at.isoformat(), "kind": self.kind, "trace_id": _current_trace_id.get(),
+            "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+            "duration_ms": round(duration_ms, 3), "status": "error" if self.error else "ok"
+        }
+        if self.error: record["error"] = self.error
+        if self.attrs: record["attrs"] = self.attrs
+        self._extend_record(record)
+        _write(record)
+        _current_span_id.reset(self._tokens.pop())
+        return duration_ms
+    def _extend_record(self, record: dict):
+        pass
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and not self.error: self.error = f"{exc_type.__name__}: {exc}"
+        self.finish()
+        return False
+
+class Trace(Span):
+    """Raiz de um trace (requisição de webhook ou ordem da fila). Reaproveita o trace_id recebido, se for válido."""
+    kind = 'trace'
+    def __init__(self, trace_id: str = None, name: str = 'request', **attrs):
+        super().__init__(name, **attrs)
+        self.trace_id = trace_id if valid_trace_id(trace_id) else new_trace_id()
+        self._profile = None
+    def start(self):
+        self._tokens.append(_current_trace_id.set(self.trace_id))
+        super().start()
+        self._profile = profiler.start_trace_profile()
+        return self
+    def finish(self):
+        duration_ms = super().finish()
+        _current_trace_id.reset(self._tokens.pop())
+        return duration_ms
+    def _extend_record(self, record: dict):
+        if self._profile:
+            record["profile"] = profiler.finish_trace_profile(self._profile)
+            self._profile = None
+
+def span(name: str, **attrs) -> Span:
+    return Span(name, **attrs)
+
+def traced(name: str, root: bool = False, trace_id_from=None):
+    """Decorador: executa a função dentro de um span (ou de um novo trace, se root=True).
+
+    `trace_id_from` é chamado a cada execução para reaproveitar um trace_id externo
+    (por exemplo, o cabeçalho X-Trace-Id de uma notificação encaminhada entre nós).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with (Trace(trace_id_from() if trace_id_from else None, name) if root else Span(name)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    """Profiler opcional, ligado em produção via endpoint de administração.
+
+    Modo 'cprofile': uma fração (sample_rate) dos traces roda sob cProfile e o
+    resultado é salvo em PROFILE_DIR/<nome gerado>.prof, referenciado no registro do trace.
+    Modo 'sampling': uma thread coleta as pilhas de todas as threads a cada
+    interval_ms e acumula contagens no formato "collapsed" (flamegraph).
+    Ambos desligam sozinhos após duration_s.
+
+    O estado é por processo: sob gunicorn com vários workers, o endpoint liga o
+    profiler apenas no worker que recebeu a requisição (o pid vai no status).
+    """
+    MODES = ('cprofile', 'sampling')
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.mode, self.sample_rate, self.expires_at = None, 0.0, 0
+        self.interval_ms = 10
+        self.stack_counts = Counter()
+        self.samples_taken = 0
+        self.profiles_written = []
+        self._sampler_thread = None
+        self._stop_event = threading.Event()
+    def start(self, mode: str, duration_s: float = 60, sample_rate: float = 0.1, interval_ms: int = 10):
+        if mode not in self.MODES: raise ValueError(f"Modo de profiling inválido: {mode}")
+        self.stop()
+        with self._lock:
+            self.mode, self.expires_at = mode, time.time() + float(duration_s)
+            self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+            self.interval_ms = max(int(interval_ms), 1)
+            self.stack_counts, self.samples_taken, self.profiles_written = Counter(), 0, []
+            if mode == 'sampling':
+                self._stop_event = threading.Event()
+                self._sampler_thread = threading.Thread(target=self._sample_stacks, args=(self._stop_event,), daemon=True)
+                self._sampler_thread.start()
+        print(f"--- 🔬 Profiling '{mode}' ativado por {duration_s}s. ---")
+        return self.status()
+    def stop(self):
+        with self._lock:
+            was_sampling = self.mode == 'sampling'
+            self.mode = None
+            self._stop_event.set()
+        if was_sampling and self.stack_counts: self._dump_stacks()
+        return self.status()
+    def _active(self, mode: str) -> bool:
+        if self.mode != mode: return False
+        if time.time() >= self.expires_at:
+            self.stop()
+            return False
+        return True
+    def start_trace_profile(self):
+        if not self._active('cprofile') or random.random() >= self.sample_rate: return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None  # outro profiler já ativo neste processo
+        return profile
+    def finish_trace_profile(self, profile) -> str:
+        profile.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"trace-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.prof")
+        profile.dump_stats(path)
+        with self._lock: self.profiles_written.append(path)
+        return path
+    def _sample_stacks(self, stop_event: threading.Event):
+        own_ident = threading.get_ident()
+        while not stop_event.wait(self.interval_ms / 1000):
+            if not self._active('sampling'): break
+            tick = Counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident: continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                tick[';'.join(reversed(stack))] += 1
+            with self._lock:
+                self.stack_counts.update(tick)
+                self.samples_taken += 1
+    def _dump_stacks(self) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"stacks-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}.txt")
+        with self._lock: stacks = self.stack_counts.most_common()
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks: f.write(f"{stack} {count}\n")
+        with self._lock: self.profiles_written.append(path)
+        print(f"--- 🔬 Pilhas amostradas gravadas em {path}. ---")
+        return path
+    def status(self) -> dict:
+        remaining = max(self.expires_at - time.time(), 0) if self.mode else 0
+        with self._lock: top_stacks = self.stack_counts.most_common(10)
+        return {
+            "pid": os.getpid(), "mode": self.mode, "sample_rate": self.sample_rate, "interval_ms": self.interval_ms,
+            "remaining_s": round(remaining, 1), "samples_taken": self.samples_taken,
+            "top_stacks": [{"stack": s, "count": c} for s, c in top_stacks],
+            "profiles_written": self.profiles_written[-20:]
+        }
+
+def summarize_profile(path: str, limit: int = 25) -> str:
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+profiler = SamplingProfiler()
+
+def secrets_match(provided, expected: str) -> bool:
+    """Compara segredos em tempo constante; sem segredo configurado, nega tudo."""
+    if not expected or not provided: return False
+    return hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8'))
+
+def is_admin_request(headers, admin_token: str) -> bool:
+    return secrets_match(headers.get(ADMIN_TOKEN_HEADER), admin_token)
+
+def register_profiling_endpoint(app, admin_token: str):
+    """Expõe /admin/profiling (GET status, POST liga, DELETE desliga), protegido por X-Admin-Token.
+
+    Age apenas sobre o processo que atende a requisição; veja SamplingProfiler.
+    """
+    from flask import request, jsonify
+
+    @app.route("/admin/profiling", methods=['GET', 'POST', 'DELETE'])
+    def admin_profiling():
+        if not is_admin_request(request.headers, admin_token):
+            return jsonify({"error": "forbidden"}), 403
+        if request.method == 'GET':
+            profile_path = request.args.get('profile')
+            if profile_path:
+                if profile_path not in profiler.profiles_written or not profile_path.endswith('.prof'):
+                    return jsonify({"error": "profile desconhecido"}), 404
+                return jsonify({"profile": profile_path, "summary": summarize_profile(profile_path)}), 200
+            return jsonify(profiler.status()), 200
+        if request.method == 'DELETE':
+            return jsonify(profiler.stop()), 200
+        params = request.get_json(silent=True) or {}
+        try:
+            status = profiler.start(params.get('mode', 'sampling'), params.get('duration_s', 60), params.get('sample_rate', 0.1), params.get('interval_ms', 10))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(status), 200
+    return admin_profiling